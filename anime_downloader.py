@@ -1,7 +1,7 @@
 """Module to download anime episodes from a given AnimeUnity URL.
 
 It extracts the anime ID, formats the anime name, retrieves episode IDs and
-URLs, and downloads episodes concurrently.
+URLs, resolves the episode download links, and downloads episodes concurrently.
 
 Usage:
     - Run the script with the URL of the anime page as a command-line argument.
@@ -13,93 +13,278 @@ from __future__ import annotations
 import argparse
 import asyncio
 import logging
-import random
 import time
 from argparse import ArgumentParser
+from contextlib import nullcontext
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import requests
+import urllib3
 from rich.live import Live
 
-from helpers.config import prepare_headers
+from helpers.config import (
+    CRAWLER_WORKERS,
+    DOWNLOAD_SPLITS,
+    DOWNLOAD_WORKERS,
+    PROGRESS_REFRESH_RATE,
+    prepare_headers,
+)
 from helpers.crawler.crawler import Crawler
-from helpers.crawler.crawler_utils import extract_download_link
+from helpers.crawler.crawler_utils import fetch_with_retries, read_download_link
 from helpers.download_utils import (
+    RangeNotHonoredError,
     get_episode_filename,
+    get_ranged_file_size,
+    open_download_stream,
+    remove_special_characters,
     run_in_parallel,
+    save_file_in_ranges,
     save_file_with_progress,
 )
 from helpers.general_utils import (
     clear_terminal,
+    create_async_client,
     create_download_directory,
-    fetch_page,
-    fetch_page_httpx,
+    create_session,
+    fetch_page_until,
+    get_backoff_delay,
+    run_async,
 )
 from helpers.progress_utils import create_progress_bar, create_progress_table
 
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from httpx import AsyncClient
+
 HEADERS = prepare_headers()
+SESSION = create_session(HEADERS, pool_size=DOWNLOAD_WORKERS * DOWNLOAD_SPLITS)
 
 
-def download_episode(
+def download_in_ranges(
     download_link: str,
-    download_path: str,
+    temp_path: Path,
+    task_info: tuple,
+    completed_ranges: set[tuple[int, int]],
+) -> bool:
+    """Download an episode in concurrent byte ranges, when the server allows it.
+
+    Return False when the episode cannot be downloaded in ranges, either because the
+    server does not advertise them or because it ignored a range request, so that it
+    is downloaded as a single stream instead. The ranges already downloaded by the
+    previous attempts, found in `completed_ranges`, are not downloaded again.
+    """
+    file_size = get_ranged_file_size(SESSION, download_link)
+    if not file_size:
+        return False
+
+    try:
+        save_file_in_ranges(
+            SESSION, download_link, temp_path, file_size, task_info, completed_ranges,
+        )
+
+    except RangeNotHonoredError as range_err:
+        message = f"{range_err}, falling back to a single stream"
+        logging.warning(message)
+        return False
+
+    return True
+
+
+def download_episode(
+    episode: tuple[str, Path],
     task_info: tuple,
     retries: int = 4,
 ) -> None:
-    """Download an episode from the download link and provides progress updates."""
+    """Download an episode from the download link and provides progress updates.
+
+    Connection errors and retryable status codes are already retried by the session;
+    the loop only recovers from failures that happen while streaming the body, resuming
+    the partial file left by the previous attempt or run when possible. Episodes that
+    cannot be downloaded in ranges go through the single stream for all the attempts.
+    The error of the last attempt is raised once all of them failed.
+    """
+    download_link, final_path = episode
+    temp_path = final_path.with_name(f"{final_path.name}.part")
+    use_ranges = True
+    completed_ranges = set()
+
     for attempt in range(retries):
         try:
-            response = requests.get(
-                download_link, stream=True, headers=HEADERS, timeout=10,
-            )
-            response.raise_for_status()
+            if use_ranges:
+                use_ranges = download_in_ranges(
+                    download_link, temp_path, task_info, completed_ranges,
+                )
+
+            if not use_ranges:
+                response, offset = open_download_stream(
+                    SESSION, download_link, temp_path,
+                )
+                save_file_with_progress(response, temp_path, task_info, offset)
 
-            filename = get_episode_filename(download_link)
-            final_path = Path(download_path) / filename
-            save_file_with_progress(response, final_path, task_info)
+            # Only complete episodes get their final name
+            temp_path.replace(final_path)
             break
 
-        except requests.RequestException:
-            if attempt < retries - 1:
-                delay = 10 * (attempt + 1) + random.uniform(0, 2)  # noqa: S311
-                time.sleep(delay)
+        except (requests.RequestException, urllib3.exceptions.HTTPError):
+            if attempt == retries - 1:
+                raise
+
+            time.sleep(get_backoff_delay(attempt, base=5))
+
+
+def plan_download(
+    download_link: str | None, download_path: Path, episode_number: str,
+) -> tuple[str, Path] | None:
+    """Pair a download link with the path of its episode file.
+
+    Links that could not be resolved are dropped, and so are the episodes whose file
+    already exists, since files only get their final name once fully downloaded. File
+    names left without a stem once cleaned, such as fully non-ASCII ones, are named
+    after the episode number instead.
+    """
+    if download_link is None:
+        return None
+
+    filename = get_episode_filename(download_link)
+    if not filename.partition(".")[0]:
+        episode_name = remove_special_characters(f"Episode_{episode_number}")
+        filename = episode_name + filename
+
+    final_path = download_path / filename
+    if final_path.is_file():
+        return None
 
+    return download_link, final_path
 
-def process_video_url(video_url: str, download_path: str, task_info: tuple) -> None:
-    """Process an embed URL to extract episode download links."""
-    soup = fetch_page(video_url)
-    script_items = soup.find_all("script")
-    download_link = extract_download_link(script_items, video_url)
-    download_episode(download_link, download_path, task_info)
 
+async def get_download_link(
+    video_url: str, semaphore: asyncio.Semaphore, client: AsyncClient,
+) -> str | None:
+    """Fetch the embed page of a video URL and extract the episode download link."""
+    return await fetch_with_retries(
+        client, video_url, semaphore, reader=read_download_link,
+    )
+
+
+async def get_episode_download_link(
+    crawler: Crawler, episode_number: str, embed_url: str,
+) -> tuple[str, str | None]:
+    """Resolve the download link of an episode, from its embed URL to its embed page.
+
+    The link is returned along with the number of the episode.
+    """
+    video_url = await crawler.get_video_url(embed_url)
+    if video_url is None:
+        return episode_number, None
+
+    download_link = await get_download_link(
+        video_url, crawler.semaphore, crawler.client,
+    )
+    return episode_number, download_link
+
+
+async def iter_download_links(
+    crawler: Crawler,
+) -> AsyncIterator[tuple[str, str | None]]:
+    """Yield the download links of the episodes as soon as each one is resolved.
+
+    Each episode goes through its embed URL and its embed page as soon as its own
+    requests complete, instead of waiting for the video URLs of all the episodes.
+    All the requests share the client and the concurrency limit of the crawler, and
+    each link is yielded along with the number of its episode, since the links do not
+    arrive in the order of the episodes.
+    """
+    embed_urls = await crawler.collect_embed_urls()
+    tasks = [
+        asyncio.create_task(
+            get_episode_download_link(crawler, episode_number, embed_url),
+        )
+        for episode_number, embed_url in embed_urls
+    ]
+
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    finally:
+        for task in tasks:
+            task.cancel()
 
-def download_anime(anime_name: str, video_urls: list[str], download_path: str) -> None:
-    """Download episodes of a specified anime from provided video URLs."""
+
+async def plan_downloads(
+    download_links: AsyncIterator[tuple[str, str | None]], download_path: Path,
+) -> AsyncIterator[tuple[str, tuple[str, Path]]]:
+    """Yield the episodes to download with their numbers, as their links arrive."""
+    async for episode_number, download_link in download_links:
+        episode = plan_download(download_link, download_path, episode_number)
+        if episode is not None:
+            yield episode_number, episode
+
+
+async def download_anime(
+    anime_name: str,
+    download_links: AsyncIterator[tuple[str, str | None]],
+    download_path: Path,
+    num_episodes: int,
+) -> None:
+    """Download episodes of a specified anime from provided download links.
+
+    Downloads start as soon as the first links are resolved, while the crawl of the
+    other episodes goes on.
+    """
+    download_plan = plan_downloads(download_links, download_path)
     job_progress = create_progress_bar()
     progress_table = create_progress_table(anime_name, job_progress)
 
-    with Live(progress_table, refresh_per_second=10):
-        run_in_parallel(process_video_url, video_urls, job_progress, download_path)
+    with Live(progress_table, refresh_per_second=PROGRESS_REFRESH_RATE):
+        await run_in_parallel(
+            download_episode, download_plan, job_progress, num_items=num_episodes,
+        )
 
 
 async def process_anime_download(
     url: str,
     start_episode: int | None = None,
     end_episode: int | None = None,
+    client: AsyncClient | None = None,
 ) -> None:
-    """Process the download of an anime from the specified URL."""
-    soup = fetch_page_httpx(url)
-    crawler = Crawler(url=url, start_episode=start_episode, end_episode=end_episode)
-    video_urls = await crawler.collect_video_urls()
+    """Process the download of an anime from the specified URL.
 
-    try:
-        anime_name = crawler.extract_anime_name(soup)
-        download_path = create_download_directory(anime_name)
-        download_anime(anime_name, video_urls, download_path)
+    When a client is provided its pooled connections are reused, otherwise a dedicated
+    client is opened to crawl the anime.
+    """
+    client_context = (
+        nullcontext(client)
+        if client
+        else create_async_client(HEADERS, max_connections=CRAWLER_WORKERS)
+    )
+
+    async with client_context as crawl_client:
+        crawler, tree = await asyncio.gather(
+            Crawler.create(
+                url=url,
+                start_episode=start_episode,
+                end_episode=end_episode,
+                client=crawl_client,
+            ),
+            fetch_page_until(url, crawl_client, "h1", Crawler.is_title_heading),
+        )
+
+        try:
+            anime_name = crawler.extract_anime_name(tree)
+            download_path = create_download_directory(anime_name)
+            await download_anime(
+                anime_name,
+                iter_download_links(crawler),
+                download_path,
+                crawler.num_episodes,
+            )
 
-    except ValueError as val_err:
-        message = f"Value error: {val_err}"
-        logging.exception(message)
+        except ValueError as val_err:
+            message = f"Value error: {val_err}"
+            logging.exception(message)
 
 
 def setup_parser() -> ArgumentParser:
@@ -128,4 +313,4 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())
@@ -5,6 +5,7 @@ progress tracking, and more.
 
 Modules:
     - config: Constants and settings used across the project.
+    - crawler: Subpackage crawling the episodes of an anime.
     - download_utils: Functions for handling downloads.
     - file_utils: Utilities for managing file operations.
     - general_utils: Miscellaneous utility functions.
@@ -18,6 +19,7 @@ to be easily imported and used across different parts of the application.
 
 __all__ = [
     "config",
+    "crawler",
     "download_utils",
     "file_utils",
     "general_utils",
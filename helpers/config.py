@@ -4,6 +4,8 @@ These configurations aim to improve modularity and readability by consolidating
 into a single location.
 """
 
+from functools import lru_cache
+
 from fake_useragent import UserAgent
 
 DOWNLOAD_FOLDER = "Downloads"  # The folder where downloaded files will be stored.
@@ -14,27 +16,42 @@ CRAWLER_WORKERS = 8            # The maximum number of worker threads for crawli
                                # tasks.
 DOWNLOAD_WORKERS = 2           # The maximum number of worker threads for downloading
                                # tasks.
+DOWNLOAD_SPLITS = 4            # The number of byte ranges of an episode downloaded
+                               # concurrently, when the server supports it.
+PROGRESS_REFRESH_RATE = 4      # The number of times per second the progress display
+                               # is refreshed.
+
+# Download workers report their progress at the same pace the display is refreshed;
+# any update in between would be overwritten before being rendered.
+PROGRESS_UPDATE_INTERVAL = 1 / PROGRESS_REFRESH_RATE
+
+# Status codes signaling a transient failure, retried both by the download session
+# and by the crawler.
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
 
 # Constants for file sizes, expressed in bytes.
 KB = 1024
 MB = 1024 * KB
 
-# Thresholds for file sizes and corresponding chunk sizes used during download.
-# Each tuple represents: (file size threshold, chunk size to download in that range).
-THRESHOLDS = [
-    (50 * MB, 128 * KB),   # Less than 50 MB
-    (100 * MB, 256 * KB),  # 50 MB to 100 MB
-    (250 * MB, 1 * MB),    # 100 MB to 250 MB
-]
+# Chunk sizes are derived from the file size, so that every file is read in about
+# TARGET_CHUNKS reads, bounded so that small files are not read in tiny pieces and
+# large files do not pin large buffers in memory.
+TARGET_CHUNKS = 256
+MIN_CHUNK_SIZE = 64 * KB
+MAX_CHUNK_SIZE = 8 * MB
 
-# Default chunk size for files larger than the largest threshold.
-LARGE_FILE_CHUNK_SIZE = 2 * MB
-
-# Creating a user-agent rotator
-USER_AGENT_ROTATOR = UserAgent(use_external_data=True)
+# Files smaller than this size are downloaded as a single stream, since splitting them
+# in byte ranges would not compensate for the extra requests.
+MIN_SPLIT_SIZE = 16 * MB
 
 
+@lru_cache(maxsize=1)
 def prepare_headers() -> dict:
-    """Prepare a random HTTP headers with a user-agent string for making requests."""
-    user_agent = str(USER_AGENT_ROTATOR.firefox)
+    """Prepare a random HTTP headers with a user-agent string for making requests.
+
+    The user agent is picked once per run from the data bundled with fake_useragent,
+    and the same headers are returned to every caller afterwards.
+    """
+    user_agent_rotator = UserAgent(use_external_data=False, browsers=["firefox"])
+    user_agent = str(user_agent_rotator.firefox)
     return {"User-Agent": user_agent}
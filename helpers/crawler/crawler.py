@@ -8,28 +8,35 @@ from __future__ import annotations
 
 import asyncio
 import logging
-import re
 from typing import TYPE_CHECKING
 
-import httpx
+from lxml import etree
 
-from helpers.config import (
-    CRAWLER_WORKERS,
-    prepare_headers,
-)
+from helpers.config import CRAWLER_WORKERS
 
 from .crawler_utils import (
     episode_in_range,
     extract_host_domain,
     fetch_with_retries,
+    parse_json,
     validate_episode_range,
     validate_url,
 )
 
 if TYPE_CHECKING:
-    from requests import BeautifulSoup
+    import httpx
+
+# Text of the first <h1> tag having the "title" class among its classes
+TITLE_XPATH = etree.XPath(
+    "normalize-space("
+    "(//h1[contains(concat(' ', normalize-space(@class), ' '), ' title ')])[1]"
+    ")",
+)
 
-HEADERS = prepare_headers()
+# Whether an element has the "title" class among its classes
+TITLE_CLASS_XPATH = etree.XPath(
+    "contains(concat(' ', normalize-space(@class), ' '), ' title ')",
+)
 
 
 class Crawler:
@@ -44,62 +51,94 @@ class Crawler:
         url: str,
         start_episode: int | None,
         end_episode: int | None,
+        client: httpx.AsyncClient,
         max_workers: int = CRAWLER_WORKERS,
     ) -> None:
-        """Initialize the crawler."""
+        """Initialize the crawler.
+
+        The client is owned by the caller, and all the requests of the crawler are
+        multiplexed over its pooled connections. Use `create` to get a crawler that
+        already knows the number of episodes.
+        """
         self.host_domain = extract_host_domain(url)
         self.api_url = self._generate_api_url(url)
-        self.num_episodes = self._get_num_episodes()
+        self.client = client
+        self.num_episodes = None
         self.start_episode = start_episode
         self.end_episode = end_episode
         self.semaphore = asyncio.Semaphore(max_workers)
 
-    async def collect_video_urls(self) -> list[str]:
-        """Collect a list of video URLs by concurrently fetching each embed URL."""
-        episode_ids = await self._collect_episode_ids()
-        embed_urls = self._generate_episode_embed_urls(episode_ids)
-        tasks = [self._get_video_url(embed_url) for embed_url in embed_urls]
-        return await asyncio.gather(*tasks)
+    @classmethod
+    async def create(
+        cls,
+        url: str,
+        start_episode: int | None,
+        end_episode: int | None,
+        client: httpx.AsyncClient,
+        max_workers: int = CRAWLER_WORKERS,
+    ) -> Crawler:
+        """Create a crawler, retrieving the number of episodes through the client."""
+        crawler = cls(url, start_episode, end_episode, client, max_workers=max_workers)
+        crawler.num_episodes = await crawler._get_num_episodes()  # noqa: SLF001
+        return crawler
+
+    async def collect_embed_urls(self) -> list[tuple[str, str]]:
+        """Collect the embed URLs of the episodes in the selected range.
+
+        Each embed URL is paired with the number of its episode, as listed by the API.
+        """
+        episodes = await self._collect_episodes()
+        return self._generate_episode_embed_urls(episodes)
+
+    async def get_video_url(self, embed_url: str) -> str | None:
+        """Fetch the video URL from an embed URL."""
+        response = await fetch_with_retries(self.client, embed_url, self.semaphore)
+        if response:
+            return response.text.strip()
+
+        return None
 
     # Static methods
     @staticmethod
-    def extract_anime_name(soup: BeautifulSoup) -> str:
-        """Extract the anime name from the provided BeautifulSoup object."""
-        try:
-            title_container = soup.find("h1", {"class": "title"})
-            if title_container is None:
-                logging.error("Anime title tag not found.")
+    def is_title_heading(element: etree._Element) -> bool:
+        """Check whether a <h1> element of the anime page holds the anime title."""
+        return TITLE_CLASS_XPATH(element)
+
+    @staticmethod
+    def extract_anime_name(tree: etree._Element) -> str:
+        """Extract the anime name from the parsed HTML of the anime page.
 
-            return title_container.get_text().strip()
+        Any element of a partially parsed page can be given, as long as the title
+        heading has already been parsed.
+        """
+        anime_name = TITLE_XPATH(tree)
+        if not anime_name:
+            message = "Anime title tag not found."
+            raise ValueError(message)
 
-        except AttributeError as attr_err:
-            message = f"Error extracting anime name: {attr_err}"
-            logging.exception(message)
+        return anime_name
 
     # Private methods
-    def _get_num_episodes(self, timeout: int = 10) -> int:
+    async def _get_num_episodes(self) -> int:
         """Retrieve total number of episodes for the selected media."""
-        response = httpx.get(
-            url=self.api_url,
-            headers=HEADERS,
-            timeout=timeout,
-        )
+        response = await self.client.get(self.api_url)
         response.raise_for_status()
-        response_json = response.json()
-        return response_json["episodes_count"]
+        return parse_json(response)["episodes_count"]
 
     def _generate_api_url(self, url: str) -> str | None:
-        """Generate the API URL based on the provided base URL."""
+        """Generate the API URL based on the provided base URL.
+
+        The anime ID is the path segment following `/anime/`, made of the numeric ID
+        of the anime and its slug, such as `1517-yuru-yuri`.
+        """
         validated_url = validate_url(url)
-        escaped_host_domain = re.escape(self.host_domain)
-        match = re.match(
-            rf"https://{escaped_host_domain}/anime/(\d+-[^/]+)",
-            validated_url,
-        )
+        anime_prefix = f"https://{self.host_domain}/anime/"
 
-        if match:
-            anime_id = match.group(1)
-            return f"https://{self.host_domain}/info_api/{anime_id}"
+        if validated_url.startswith(anime_prefix):
+            anime_id = validated_url[len(anime_prefix):].partition("/")[0]
+            number, separator, slug = anime_id.partition("-")
+            if number.isdigit() and separator and slug:
+                return f"https://{self.host_domain}/info_api/{anime_id}"
 
         logging.error("URL format is incorrect.")
         return None
@@ -113,13 +152,10 @@ class Crawler:
         }
 
         response = await fetch_with_retries(
-            episode_api_url,
-            self.semaphore,
-            headers=HEADERS,
-            params=params,
+            self.client, episode_api_url, self.semaphore, params=params,
         )
         if response:
-            episode_info = response.json().get("episodes", [])
+            episode_info = parse_json(response).get("episodes", [])
             return (
                 [(ep["id"], ep["number"]) for ep in episode_info]
                 if episode_info
@@ -128,32 +164,23 @@ class Crawler:
 
         return None
 
-    async def _collect_episode_ids(self) -> list[int]:
-        """Retrieve a list of episode IDs from a given URL."""
+    async def _collect_episodes(self) -> list[tuple[int, str]]:
+        """Retrieve the IDs and numbers of the episodes in the selected range."""
         validate_episode_range(self.start_episode, self.end_episode, self.num_episodes)
 
         episodes = await self._get_episode_ids()
         return [
-            ep[0]
+            ep
             for ep in episodes
             if episode_in_range(ep[1], self.start_episode, self.end_episode)
         ]
 
-    def _generate_episode_embed_urls(self, episode_ids: str) -> list[str]:
-        """Generate a list of embed URLs for a series of episodes."""
+    def _generate_episode_embed_urls(
+        self, episodes: list[tuple[int, str]],
+    ) -> list[tuple[str, str]]:
+        """Generate the embed URLs of a series of episodes, along with their numbers."""
+        embed_url_prefix = f"https://{self.host_domain}/embed-url/"
         return [
-            f"https://{self.host_domain}/embed-url/{episode_id}"
-            for episode_id in episode_ids
+            (number, embed_url_prefix + str(episode_id))
+            for episode_id, number in episodes
         ]
-
-    async def _get_video_url(self, embed_url: str) -> str | None:
-        """Fetch the video URL from an embed URL."""
-        response = await fetch_with_retries(
-            embed_url,
-            self.semaphore,
-            headers=HEADERS,
-        )
-        if response:
-            return response.text.strip()
-
-        return None
@@ -8,31 +8,40 @@ from __future__ import annotations
 
 import asyncio
 import logging
-import random
 import re
 import sys
 from asyncio import Semaphore
-from typing import Optional
-from urllib.parse import urlparse
+from typing import TYPE_CHECKING, Any, Optional
 
 import httpx
+import orjson
 
-from helpers.config import prepare_headers
+from helpers.config import RETRY_STATUS_CODES
+from helpers.general_utils import can_abandon_body, get_retry_after_delay
 
-HEADERS = prepare_headers()
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+# Matched against the undecoded body of the embed page, so that the page is never
+# decoded to text as a whole
+DOWNLOAD_LINK_PATTERN = re.compile(
+    rb"window\.downloadUrl\s*=\s*'(https?:\/\/[^\s']+)'",
+)
+DOWNLOAD_LINK_MARKER = b"window.downloadUrl"
 
 
 def validate_url(url: str) -> str:
     """Validate a URL by ensuring it does not have a trailing slash."""
-    if url.endswith("/"):
-        return url.rstrip("/")
-    return url
+    return url.rstrip("/")
 
 
 def extract_host_domain(url: str) -> str:
-    """Extract the host/domain name from a given URL."""
-    parsed_url = urlparse(url)
-    return parsed_url.netloc
+    """Extract the host/domain name from a given URL.
+
+    The host is the part following the scheme, when there is one, up to the first
+    slash of the path.
+    """
+    return url.split("://", 1)[-1].split("/", 1)[0]
 
 
 def validate_episode_range(
@@ -77,50 +86,98 @@ def episode_in_range(num: str, start: Optional[int], end: Optional[int]) -> bool
     )
 
 
+def parse_json(response: httpx.Response) -> dict:
+    """Parse the JSON body of a response with orjson, straight from its bytes."""
+    return orjson.loads(response.content)
+
+
 async def fetch_with_retries(
+    client: httpx.AsyncClient,
     url: str,
     semaphore: Semaphore,
-    headers: dict | None = None,
     params: dict | None = None,
     retries: int = 4,
-) -> dict | None:
-    """Fetch data from a URL with retries on failure."""
+    reader: Callable[[httpx.Response], Awaitable[Any]] | None = None,
+) -> Any:
+    """Fetch data from a URL with retries on failure.
+
+    Requests are sent through the given client, so that they reuse its pooled
+    connections and carry its headers. Connection failures are retried by the
+    transport of the client, while only rate limiting and server errors are retried
+    here, honoring the Retry-After header when the server sends one.
+
+    The whole response is returned, unless a reader is given: the body is then
+    streamed to the reader, which may stop early, and its result is returned instead.
+    """
     async with semaphore:
-        async with httpx.AsyncClient() as client:
-            for attempt in range(retries):
-                try:
-                    response = await client.get(
-                        url,
-                        headers=headers,
-                        params=params,
-                        timeout=10,
-                    )
-                    response.raise_for_status()
-                    return response
-
-                except httpx.HTTPStatusError:
-                    if attempt < retries - 1:
-                        delay = 2**attempt + random.uniform(0, 2)  # noqa: S311
-                        await asyncio.sleep(delay)
-
-                except httpx.RequestError as req_err:
-                    message = f"Request failed for {url}: {req_err}"
-                    logging.exception(message)
-                    return None
+        for attempt in range(retries):
+            try:
+                async with client.stream("GET", url, params=params) as response:
+                    status_code = response.status_code
+                    if status_code not in RETRY_STATUS_CODES or attempt == retries - 1:
+                        return await read_response(response, reader)
+
+                    delay = get_retry_after_delay(response, attempt)
+
+            except httpx.RequestError as req_err:
+                message = f"Request failed for {url}: {req_err}"
+                logging.exception(message)
+                return None
+
+            await asyncio.sleep(delay)
 
     return None
 
 
-def extract_download_link(script_items: list, video_url: str) -> str | None:
-    """Extract the download URL from a list of script items."""
-    pattern = r"window\.downloadUrl\s*=\s*'(https?:\/\/[^\s']+)'"
+async def read_response(
+    response: httpx.Response,
+    reader: Callable[[httpx.Response], Awaitable[Any]] | None,
+) -> Any:
+    """Read a successful streamed response, through the reader when one is given."""
+    if response.is_error:
+        status_code = response.status_code
+        message = f"Request failed for {response.url} with status {status_code}"
+        logging.error(message)
+        return None
+
+    if reader is not None:
+        return await reader(response)
 
-    for item in script_items:
-        match = re.search(pattern, item.text)
-        if match:
-            return match.group(1)
+    await response.aread()
+    return response
 
-    # Return None if no download link is found
-    message = f"Error extracting the download link for {video_url}"
-    logging.error(message)
-    return None
+
+async def read_download_link(response: httpx.Response) -> str | None:
+    """Read the raw content of an embed page until its download URL is found.
+
+    The marker of the assignment is located with a plain substring search first, so
+    that the regex only runs from there. Once the URL is found, the rest of the page
+    is only downloaded, without being searched, when the connection would not be
+    reused otherwise.
+    """
+    page_content = bytearray()
+    marker_index = -1
+    download_link = None
+
+    async for chunk in response.aiter_bytes():
+        if download_link is not None:
+            continue
+
+        search_start = max(0, len(page_content) - len(DOWNLOAD_LINK_MARKER) + 1)
+        page_content += chunk
+
+        if marker_index == -1:
+            marker_index = page_content.find(DOWNLOAD_LINK_MARKER, search_start)
+
+        if marker_index != -1:
+            match = DOWNLOAD_LINK_PATTERN.search(page_content, marker_index)
+            if match:
+                download_link = match.group(1).decode()
+                if can_abandon_body(response):
+                    break
+
+    if download_link is None:
+        message = f"Error extracting the download link for {response.url}"
+        logging.error(message)
+
+    return download_link
@@ -2,104 +2,490 @@
 
 from __future__ import annotations
 
+import asyncio
+import errno
 import logging
-import re
-from concurrent.futures import ThreadPoolExecutor
-from pathlib import Path
-from typing import TYPE_CHECKING
-from urllib.parse import unquote
+import os
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import suppress
+from functools import partial
+from queue import Queue
+from typing import TYPE_CHECKING, Any
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import requests
 
 from .config import (
+    DOWNLOAD_SPLITS,
     DOWNLOAD_WORKERS,
-    LARGE_FILE_CHUNK_SIZE,
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    MIN_SPLIT_SIZE,
+    PROGRESS_UPDATE_INTERVAL,
+    TARGET_CHUNKS,
     TASK_COLOR,
-    THRESHOLDS,
 )
 
 if TYPE_CHECKING:
-    from requests import Response
+    from collections.abc import AsyncIterable
+    from pathlib import Path
+
+    from requests import Response, Session
     from rich.progress import Progress
 
+# Episodes are requested without content encoding, so that their bodies are written to
+# disk as they are read and the offsets of byte ranges match the ones of the file.
+IDENTITY_HEADERS = {"Accept-Encoding": "identity"}
+
+# Characters kept in the names of the episode files, any other one is dropped. Names
+# are cleaned as ASCII bytes, so the table only lists the other ASCII characters.
+ALLOWED_FILENAME_CHARS = string.ascii_letters + string.digits + "_.-"
+FILENAME_DELETE_BYTES = bytes(
+    code for code in range(128) if chr(code) not in ALLOWED_FILENAME_CHARS
+)
+
+
+class RangeNotHonoredError(requests.HTTPError):
+    """Raised when a range request is answered with something else than the range."""
+
 
 def remove_special_characters(input_string: str) -> str:
-    """Remove special characters from the input string."""
-    return re.sub(r"[^a-zA-Z0-9_.-]", "", input_string)
+    """Remove special characters from the input string.
+
+    Non-ASCII characters are dropped by the encoding, and the remaining special ones by
+    a single bytes translation, which are both plain loops in C.
+    """
+    ascii_bytes = input_string.encode("ascii", "ignore")
+    return ascii_bytes.translate(None, FILENAME_DELETE_BYTES).decode("ascii")
 
 
 def get_episode_filename(download_link: str) -> str | None:
-    """Extract the file name from the provided episode download link."""
-    if download_link:
-        try:
-            filename = unquote(download_link.split("=")[-1])  # Original name
-            return remove_special_characters(filename)  # Cleaned name
+    """Extract the file name from the provided episode download link.
 
-        except IndexError as indx_err:
-            message = f"Error while extracting the file name: {indx_err}"
-            logging.exception(message)
+    The name is the `filename` parameter of the query string, wherever it appears in
+    it, with the last value of the link as a fallback when the parameter is missing.
+    """
+    if not download_link:
+        return None
 
-    return None
+    query = parse_qs(urlsplit(download_link).query)
+    filenames = query.get("filename") or [unquote(download_link.rpartition("=")[2])]
+    return remove_special_characters(filenames[0])
 
 
 def get_chunk_size(file_size: int) -> int:
-    """Determine the optimal chunk size based on the file size."""
-    for threshold, chunk_size in THRESHOLDS:
-        if file_size < threshold:
-            return chunk_size
+    """Determine the optimal chunk size based on the file size.
+
+    The chunk size is the power of two that reads the file in about `TARGET_CHUNKS`
+    reads, clamped between `MIN_CHUNK_SIZE` and `MAX_CHUNK_SIZE`. Unknown sizes get the
+    smallest chunk size.
+    """
+    if file_size <= 0:
+        return MIN_CHUNK_SIZE
+
+    target_size = -(-file_size // TARGET_CHUNKS)
+    chunk_size = 1 << (target_size - 1).bit_length()
+    return max(MIN_CHUNK_SIZE, min(chunk_size, MAX_CHUNK_SIZE))
+
+
+def get_content_range_start(response: Response) -> int | None:
+    """Return the offset of the first byte sent by a partial response, if known."""
+    unit, _, byte_range = response.headers.get("Content-Range", "").partition(" ")
+    start = byte_range.partition("-")[0]
+    if unit != "bytes" or not start.isdigit():
+        return None
+
+    return int(start)
+
+
+def open_download_stream(
+    session: Session, url: str, temp_path: Path, timeout: int = 10,
+) -> tuple[Response, int]:
+    """Open the download stream of a file, resuming a previous partial download.
+
+    Return the response along with the offset of the file it starts from, which is zero
+    when there is nothing to resume or when the server cannot resume the download. A
+    partial response that does not start where the partial file ends is discarded, and
+    the download starts over.
+    """
+    resume_offset = temp_path.stat().st_size if temp_path.exists() else 0
+
+    if resume_offset:
+        headers = {**IDENTITY_HEADERS, "Range": f"bytes={resume_offset}-"}
+        response = session.get(url, headers=headers, stream=True, timeout=timeout)
+
+        if (
+            response.status_code == requests.codes.partial_content
+            and get_content_range_start(response) == resume_offset
+        ):
+            return response, resume_offset
+
+        # The range was ignored and the whole file is being sent
+        if response.status_code == requests.codes.ok:
+            return response, 0
+
+        response.close()
+
+    response = session.get(
+        url, headers=IDENTITY_HEADERS, stream=True, timeout=timeout,
+    )
+    response.raise_for_status()
+    return response, 0
 
-    return LARGE_FILE_CHUNK_SIZE
+
+def get_progress_step(file_size: int) -> int:
+    """Return the number of bytes making up one displayed percent of a file.
+
+    Progress updates are only worth their cost once they change the percentage shown,
+    so the clock is not even read before that many bytes have been downloaded.
+    """
+    return max(file_size // 100, 1)
+
+
+def write_all(fd: int, data: bytes) -> None:
+    """Write all the data at the current position of a file descriptor."""
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
 
 
 def save_file_with_progress(
     response: Response,
-    final_path: str,
+    final_path: Path,
     task_info: tuple,
+    offset: int = 0,
 ) -> None:
-    """Save a file to the specified path while tracking and updating progress."""
-    job_progress, task, overall_task = task_info
-    file_size = int(response.headers.get("Content-Length", -1))
+    """Save a file to the specified path while tracking and updating progress.
+
+    The body is read from the raw stream in chunks written straight to the file
+    descriptor, and the progress is refreshed at most every `PROGRESS_UPDATE_INTERVAL`
+    and once per displayed percent. When an offset is given, the body is appended to
+    the partial file already there.
+    """
+    job_progress, task, _ = task_info
+    file_size = offset + int(response.headers.get("Content-Length", -1))
     chunk_size = get_chunk_size(file_size)
-    total_downloaded = 0
+    progress_step = get_progress_step(file_size)
+    total_downloaded = last_reported = offset
+    last_update = time.monotonic()
+
+    # Only decode bodies whose server applied an encoding despite the identity request
+    response.raw.decode_content = "Content-Encoding" in response.headers
 
-    with Path(final_path).open("wb") as file:
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            if chunk:
-                file.write(chunk)
-                total_downloaded += len(chunk)
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    flags |= os.O_APPEND if offset else os.O_TRUNC
+    fd = os.open(final_path, flags, 0o644)
+
+    try:
+        while chunk := response.raw.read(chunk_size):
+            write_all(fd, chunk)
+            total_downloaded += len(chunk)
+            if total_downloaded - last_reported < progress_step:
+                continue
+
+            now = time.monotonic()
+            if now - last_update >= PROGRESS_UPDATE_INTERVAL:
                 progress_percentage = (total_downloaded / file_size) * 100
                 job_progress.update(task, completed=progress_percentage)
+                last_reported = total_downloaded
+                last_update = now
+
+        release_page_cache(fd)
+
+    finally:
+        os.close(fd)
+
+    job_progress.update(task, completed=100)
+
+
+def release_page_cache(fd: int) -> None:
+    """Tell the kernel that the cached pages of a downloaded file will not be read.
+
+    Episodes are written once and not read back, so their pages only crowd out the
+    cache of other processes. Only the pages already written back are dropped, since
+    waiting for the rest to reach the disk would hold the worker. The advice is only a
+    hint, so its failures are ignored.
+    """
+    if hasattr(os, "posix_fadvise"):
+        with suppress(OSError):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def get_ranged_file_size(session: Session, url: str, timeout: int = 10) -> int | None:
+    """Retrieve the size of a file that can be downloaded in byte ranges.
+
+    Return None when the server rejects the HEAD request or does not accept range
+    requests, when the file is too small to be split, or when positional writes are not
+    available on this platform.
+    """
+    if not hasattr(os, "pwrite"):
+        return None
+
+    response = session.head(
+        url, headers=IDENTITY_HEADERS, allow_redirects=True, timeout=timeout,
+    )
+    if not response.ok:
+        return None
+
+    file_size = int(response.headers.get("Content-Length", 0))
+
+    if response.headers.get("Accept-Ranges") != "bytes" or file_size < MIN_SPLIT_SIZE:
+        return None
+
+    return file_size
 
-    job_progress.update(task, completed=100, visible=False)
-    job_progress.advance(overall_task)
 
+def get_byte_ranges(
+    file_size: int, num_splits: int, alignment: int = 1,
+) -> list[tuple[int, int]]:
+    """Split a file size into contiguous byte ranges, with inclusive bounds.
 
-def manage_running_tasks(futures: dict, job_progress: Progress) -> None:
-    """Manage the status of running tasks and update their progress."""
-    while futures:
-        for future in list(futures.keys()):
-            if future.running():
-                task = futures.pop(future)
-                job_progress.update(task, visible=True)
+    Every range but the last one spans a multiple of the alignment, so that ranges start
+    on block boundaries and no block is written by two ranges.
+    """
+    split_size = -(-file_size // num_splits)
+    split_size = -(-split_size // alignment) * alignment
+    return [
+        (start, min(start + split_size, file_size) - 1)
+        for start in range(0, file_size, split_size)
+    ]
 
 
-def run_in_parallel(
-    func: callable, items: list, job_progress: Progress, *args: tuple,
+def allocate_file(fd: int, file_size: int) -> None:
+    """Reserve the whole size of a file before its byte ranges are written.
+
+    Preallocating lets the filesystem lay out the file contiguously, even though its
+    ranges are written concurrently, and reports a full disk before downloading.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, file_size)
+            return
+
+        except OSError as os_err:
+            # Only fall back when the filesystem does not support preallocation
+            if os_err.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    os.ftruncate(fd, file_size)
+
+
+def write_at(fd: int, data: bytes, offset: int) -> None:
+    """Write all the data at the given offset of a file descriptor."""
+    data = memoryview(data)
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def save_range_with_progress(
+    session: Session,
+    url: str,
+    byte_range: tuple[int, int],
+    fd: int,
+    progress_info: tuple,
+    stop_event: threading.Event,
+) -> None:
+    """Download a byte range of a file and write it at its offset in the file.
+
+    The range must be sent whole and from its start: servers answering with another
+    range, or capping its length, cannot fill the file in ranges. The download is
+    abandoned as soon as the stop event is set.
+    """
+    job_progress, task, file_size = progress_info
+    start, end = byte_range
+    headers = {**IDENTITY_HEADERS, "Range": f"bytes={start}-{end}"}
+
+    with session.get(url, headers=headers, stream=True, timeout=10) as response:
+        response.raise_for_status()
+        if (
+            response.status_code != requests.codes.partial_content
+            or get_content_range_start(response) != start
+        ):
+            message = f"Range request not honored for {url}"
+            raise RangeNotHonoredError(message, response=response)
+
+        offset = start
+        pending = 0
+        chunk_size = get_chunk_size(file_size)
+        progress_step = get_progress_step(file_size)
+        last_update = time.monotonic()
+
+        while chunk := response.raw.read(chunk_size):
+            if stop_event.is_set():
+                return
+
+            write_at(fd, chunk, offset)
+            offset += len(chunk)
+            pending += len(chunk)
+            if pending < progress_step:
+                continue
+
+            now = time.monotonic()
+            if now - last_update >= PROGRESS_UPDATE_INTERVAL:
+                job_progress.advance(task, (pending / file_size) * 100)
+                pending = 0
+                last_update = now
+
+        if offset != end + 1:
+            message = f"Range request only partially honored for {url}"
+            raise RangeNotHonoredError(message, response=response)
+
+
+def save_file_in_ranges(
+    session: Session,
+    url: str,
+    final_path: Path,
+    file_size: int,
+    task_info: tuple,
+    completed_ranges: set[tuple[int, int]],
+) -> None:
+    """Save a file by downloading its byte ranges concurrently, tracking progress.
+
+    The file is preallocated and filled out of order. The ranges written so far are
+    added to `completed_ranges`, so that a following attempt given the same set only
+    downloads the missing ones. When a range fails, the others are stopped at once.
+    The file is removed when the server does not honor the ranges.
+    """
+    job_progress, task, _ = task_info
+    progress_info = (job_progress, task, file_size)
+    stop_event = threading.Event()
+
+    flags = os.O_WRONLY | os.O_CREAT
+    if not completed_ranges:
+        flags |= os.O_TRUNC
+
+    fd = os.open(final_path, flags, 0o644)
+    try:
+        allocate_file(fd, file_size)
+        block_size = os.fstat(fd).st_blksize
+        byte_ranges = get_byte_ranges(file_size, DOWNLOAD_SPLITS, block_size)
+        missing_ranges = [
+            byte_range
+            for byte_range in byte_ranges
+            if byte_range not in completed_ranges
+        ]
+        missing_size = sum(end - start + 1 for start, end in missing_ranges)
+        completed_percentage = (1 - missing_size / file_size) * 100
+        job_progress.update(task, completed=completed_percentage)
+
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_SPLITS) as executor:
+            futures = {
+                executor.submit(
+                    save_range_with_progress,
+                    session,
+                    url,
+                    byte_range,
+                    fd,
+                    progress_info,
+                    stop_event,
+                ): byte_range
+                for byte_range in missing_ranges
+            }
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    completed_ranges.add(futures[future])
+
+            except Exception:
+                stop_event.set()
+                raise
+
+        release_page_cache(fd)
+
+    except RangeNotHonoredError:
+        final_path.unlink(missing_ok=True)
+        raise
+
+    finally:
+        os.close(fd)
+
+    job_progress.update(task, completed=100)
+
+
+def run_task(
+    func: callable,
+    item: str,
+    *args: tuple,
+    progress_info: tuple,
+    description: str,
+) -> None:
+    """Run the function on an item, showing its progress on a free task row.
+
+    The row is taken from the pool when the item starts and given back once it is done,
+    whether it succeeded or not, after hiding it. The overall progress only advances
+    when the item succeeded, while failures are raised to the caller.
+    """
+    job_progress, task_rows, overall_task = progress_info
+    task = task_rows.get()
+    job_progress.reset(task, description=description, visible=True)
+
+    try:
+        func(item, *args, (job_progress, task, overall_task))
+
+    finally:
+        job_progress.update(task, visible=False)
+        task_rows.put(task)
+
+    job_progress.advance(overall_task)
+
+
+async def run_in_parallel(
+    func: callable,
+    items: AsyncIterable[tuple[str, Any]],
+    job_progress: Progress,
+    *args: tuple,
+    num_items: int,
 ) -> None:
-    """Execute a function in parallel for a list of items, updating progress."""
-    num_items = len(items)
-    futures = {}
+    """Execute a function in parallel for items as they arrive, updating progress.
+
+    Each item is handed to the worker threads as soon as it is produced, so that the
+    first items are processed while the following ones are still being produced. Items
+    come with their number, shown out of `num_items` on the task row, since they may
+    arrive out of order.
+
+    The progress shows one task row per worker, recycled from item to item, so that
+    the rows do not pile up with the number of items. Items whose function raised are
+    logged once all the items are done.
+    """
+    loop = asyncio.get_running_loop()
+    futures = []
+    item_numbers = []
 
     with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
         overall_task = job_progress.add_task(
-            f"[{TASK_COLOR}]Progress", total=num_items, visible=True,
+            f"[{TASK_COLOR}]Progress", total=0, visible=True,
         )
+        task_rows = Queue()
+        for _ in range(DOWNLOAD_WORKERS):
+            task_rows.put(job_progress.add_task("", total=100, visible=False))
+
+        progress_info = (job_progress, task_rows, overall_task)
 
-        for indx, item in enumerate(items):
-            task = job_progress.add_task(
-                f"[{TASK_COLOR}]Episode {indx + 1}/{num_items}",
-                total=100,
-                visible=False,
+        async for item_number, item in items:
+            job_progress.update(overall_task, total=len(futures) + 1)
+            description = f"[{TASK_COLOR}]Episode {item_number}/{num_items}"
+            future = loop.run_in_executor(
+                executor,
+                partial(
+                    run_task,
+                    func,
+                    item,
+                    *args,
+                    progress_info=progress_info,
+                    description=description,
+                ),
             )
-            task_info = (job_progress, task, overall_task)
-            future = executor.submit(func, item, *args, task_info)
-            futures[future] = task
-            manage_running_tasks(futures, job_progress)
+            futures.append(future)
+            item_numbers.append(item_number)
+
+        results = await asyncio.gather(*futures, return_exceptions=True)
+
+    for item_number, result in zip(item_numbers, results):
+        if isinstance(result, Exception):
+            message = f"Episode {item_number} failed: {result!r}"
+            logging.error(message)
@@ -1,17 +1,25 @@
 """Utility functions for file input and output operations.
 
-This module includes methods to read the contents of a file and to write content to a
-file, with optional support for clearing the file.
+This module includes methods to lazily read the lines of a file and to write content to
+a file, with optional support for clearing the file.
 """
 
+from __future__ import annotations
 
 from pathlib import Path
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from collections.abc import Iterator
 
-def read_file(filename: str) -> list[str]:
-    """Read the contents of a file and returns a list of its lines."""
+
+def read_file(filename: str) -> Iterator[str]:
+    """Read the contents of a file line by line, yielding its non-empty lines."""
     with Path(filename).open("r", encoding="utf-8") as file:
-        return file.read().splitlines()
+        for line in file:
+            stripped_line = line.strip()
+            if stripped_line:
+                yield stripped_line
 
 
 def write_file(filename: str, content: str = "") -> None:
@@ -5,40 +5,154 @@ parsing HTML, creating download directories, and  clearing the terminal, making
 reusable across projects.
 """
 
+from __future__ import annotations
+
+import asyncio
+import ctypes
 import logging
 import os
-import re
+import random
 import sys
+from importlib.util import find_spec
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import httpx
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import DOWNLOAD_FOLDER, RETRY_STATUS_CODES
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Coroutine
+
+# HTTP/2 support is provided by the optional h2 package, pulled in by httpx[http2]
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+# Characters not allowed in directory names, on Windows and on macOS and Linux, each
+# mapped to the underscore replacing it
+INVALID_DIRECTORY_CHARS = '\\/:*?"<>|' if os.name == "nt" else "/:"
+DIRECTORY_NAME_TABLE = str.maketrans(dict.fromkeys(INVALID_DIRECTORY_CHARS, "_"))
+
+# Windows console constants used to enable ANSI escape sequences
+STD_OUTPUT_HANDLE = -11
+ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+
+
+def create_session(headers: dict, pool_size: int, retries: int = 4) -> requests.Session:
+    """Create a session that pools connections and retries transient failures."""
+    retry_strategy = Retry(
+        total=retries,
+        backoff_factor=1,
+        status_forcelist=RETRY_STATUS_CODES,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry_strategy,
+    )
 
-from .config import DOWNLOAD_FOLDER
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
-def fetch_page(url: str, timeout: int = 10) -> BeautifulSoup:
-    """Fetch the HTML content of a webpage."""
-    # Create a new session per worker
-    session = requests.Session()
+def get_retry_after_delay(
+    response: httpx.Response, attempt: int, cap: float = 60,
+) -> float:
+    """Return the delay requested by the Retry-After header of a response.
 
-    try:
-        response = session.get(url, timeout=timeout)
+    Fall back to the exponential backoff when the header is missing or is not a number
+    of seconds.
+    """
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(cap, int(retry_after))
+
+    return get_backoff_delay(attempt, cap=cap)
+
+
+def get_backoff_delay(attempt: int, base: float = 1, cap: float = 60) -> float:
+    """Return the jittered exponential delay to wait before the next retry.
+
+    The delay doubles with every attempt, starting from `base` seconds, and never
+    exceeds `cap` seconds.
+    """
+    delay = base * 2**attempt + random.uniform(0, base)  # noqa: S311
+    return min(cap, delay)
+
+
+def create_async_client(
+    headers: dict, max_connections: int, timeout: int = 10, retries: int = 3,
+) -> httpx.AsyncClient:
+    """Create an HTTP/2 client that multiplexes requests over its pooled connections.
+
+    The client falls back to HTTP/1.1 when h2 is not installed, and its transport
+    retries the connections that fail to be established.
+    """
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=30,
+    )
+    transport = httpx.AsyncHTTPTransport(
+        http2=HTTP2_AVAILABLE, limits=limits, retries=retries,
+    )
+    return httpx.AsyncClient(headers=headers, transport=transport, timeout=timeout)
+
+
+def can_abandon_body(response: httpx.Response) -> bool:
+    """Check whether the rest of a streamed body can be left unread.
+
+    HTTP/2 streams are reset on their own, while HTTP/1.1 connections only go back to
+    the pool once their body has been read whole, and are closed otherwise.
+    """
+    return response.http_version == "HTTP/2"
+
+
+async def fetch_page_until(
+    url: str,
+    client: httpx.AsyncClient,
+    tag: str,
+    is_match: Callable[[etree._Element], bool],
+) -> etree._Element:
+    """Parse a webpage as it is streamed, until an element of the given tag matches.
+
+    The body is fed to lxml chunk by chunk and stops being parsed once the matching
+    element is complete, while the rest of the page is only downloaded when the
+    connection would not be reused otherwise. Return that element, which is still part
+    of the partially parsed page, or the whole page when no element matches.
+    """
+    match = None
+
+    async with client.stream("GET", url) as response:
         response.raise_for_status()
-        return BeautifulSoup(response.text, "html.parser")
+        parser = etree.HTMLPullParser(
+            events=("end",), tag=tag, encoding=response.encoding,
+        )
 
-    except requests.RequestException as req_err:
-        message = f"Error fetching page {url}: {req_err}"
-        logging.exception(message)
-        sys.exit(1)
+        async for chunk in response.aiter_bytes():
+            if match is not None:
+                continue
 
+            parser.feed(chunk)
+            match = next(
+                (element for _, element in parser.read_events() if is_match(element)),
+                None,
+            )
+            if match is not None and can_abandon_body(response):
+                break
 
-def fetch_page_httpx(url: str, timeout: int = 10) -> BeautifulSoup:
-    """Fetch the HTML content of a webpage using HTTPX."""
-    response = httpx.get(url=url, timeout=timeout)
-    response.raise_for_status()
-    return BeautifulSoup(response.text, "html.parser")
+    return match if match is not None else parser.close()
 
 
 def sanitize_directory_name(directory_name: str) -> str:
@@ -47,20 +161,15 @@ def sanitize_directory_name(directory_name: str) -> str:
     Replace invalid characters with underscores. Handles the invalid characters specific
     to Windows, macOS, and Linux.
     """
-    invalid_chars_dict = {
-        "nt": r'[\\/:*?"<>|]',  # Windows
-        "posix": r"[/:]",  # macOS and Linux
-    }
-    invalid_chars = invalid_chars_dict.get(os.name)
-    return re.sub(invalid_chars, "_", directory_name)
+    return directory_name.translate(DIRECTORY_NAME_TABLE)
 
 
-def create_download_directory(directory_name: str) -> str:
+def create_download_directory(directory_name: str) -> Path:
     """Create a directory for downloads if it doesn't exist."""
     download_path = Path(DOWNLOAD_FOLDER) / sanitize_directory_name(directory_name)
 
     try:
-        Path(download_path).mkdir(parents=True, exist_ok=True)
+        download_path.mkdir(parents=True, exist_ok=True)
         return download_path
 
     except OSError as os_err:
@@ -69,13 +178,39 @@ def create_download_directory(directory_name: str) -> str:
         sys.exit(1)
 
 
+def enable_ansi_escapes() -> bool:
+    """Ensure the terminal interprets ANSI escape sequences.
+
+    POSIX terminals always do, while Windows consoles need the virtual terminal
+    processing mode, which is enabled here when supported (Windows 10 onwards).
+    """
+    if os.name != "nt":
+        return True
+
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
+    mode = ctypes.c_ulong()
+    if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        return False
+
+    new_mode = mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING
+    return bool(kernel32.SetConsoleMode(handle, new_mode))
+
+
+def run_async(main: Coroutine) -> None:
+    """Run the main coroutine on uvloop when it is installed, on asyncio otherwise."""
+    if uvloop is not None:
+        uvloop.run(main)
+    else:
+        asyncio.run(main)
+
+
 def clear_terminal() -> None:
-    """Clear the terminal screen based on the operating system."""
-    commands = {
-        "nt": "cls",       # Windows
-        "posix": "clear",  # macOS and Linux
-    }
-
-    command = commands.get(os.name)
-    if command:
-        os.system(command)  # noqa: S605
+    """Clear the terminal screen, without spawning a shell when possible."""
+    if not enable_ansi_escapes():
+        os.system("cls")  # noqa: S605, S607
+        return
+
+    # Erase the whole screen and its scrollback, then move the cursor to the top left
+    sys.stdout.write("\x1b[2J\x1b[3J\x1b[H")
+    sys.stdout.flush()
@@ -9,18 +9,29 @@ Usage:
     content, and clear the URL list upon completion.
 """
 
-import asyncio
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
 
 from anime_downloader import process_anime_download
-from helpers.config import FILE
+from helpers.config import CRAWLER_WORKERS, FILE, prepare_headers
 from helpers.file_utils import read_file, write_file
-from helpers.general_utils import clear_terminal
+from helpers.general_utils import clear_terminal, create_async_client, run_async
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
 
 
-async def process_urls(urls: list[str]) -> None:
-    """Validate and downloads items for a list of URLs."""
-    for url in urls:
-        await process_anime_download(url)
+async def process_urls(urls: Iterable[str]) -> None:
+    """Validate and downloads items for a list of URLs.
+
+    All the anime are crawled through the same client, so that the connections to the
+    hosts they share are established only once.
+    """
+    headers = prepare_headers()
+    async with create_async_client(headers, max_connections=CRAWLER_WORKERS) as client:
+        for url in urls:
+            await process_anime_download(url, client=client)
 
 
 async def main() -> None:
@@ -35,4 +46,4 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run_async(main())